@@ -1,15 +1,23 @@
 # Python imports
+import functools
 import uuid
-import os
 import datetime
+from bisect import bisect_left, bisect_right
 from dateutil.relativedelta import relativedelta
 
 # Django imports
-from django.db import models
+from django.core.cache import cache
+from django.db import models, transaction
 
 # Project imports
 from project.utils.models import ModelWithTimestamp
 
+# Resolved on the first CSVFile parsing, see CSVFile.parse.
+_parse_csv = None
+
+# Cache key of the version of cached calculations.
+CALCULATE_CACHE_VERSION_KEY = 'calculate_data_version'
+
 
 def get_file_format(filename):
     """
@@ -25,7 +33,7 @@ def get_file_format(filename):
     str
         File format.
     """
-    return filename.split('.')[-1]
+    return filename.rpartition('.')[2]
 
 
 def get_file_path(instance, filename):
@@ -38,8 +46,113 @@ def get_file_path(instance, filename):
         New path for file.
     """
     ext = get_file_format(filename)
-    filename = "%s.%s" % (uuid.uuid4(), ext)
-    return os.path.join('%s/%s' % (instance.__class__.__name__.lower(), filename))
+    return f"{type(instance).__name__.lower()}/{uuid.uuid4().hex}.{ext}"
+
+
+def parse_date(value):
+    """
+    Returns date object for given string in "%Y-%m-%d" format.
+
+    Parameters
+    ----------
+    value: str
+        The date string.
+
+    Returns
+    -------
+    datetime.date
+    """
+    # Fast path only for "YYYY-MM-DD", fromisoformat accepts other ISO formats too.
+    if len(value) == 10 and value[4] == '-' and value[7] == '-':
+        return datetime.date.fromisoformat(value)
+    # Dates without zero padding, e.g. "2024-1-5".
+    return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def get_nearest_value(dates, values, step_date):
+    """
+    Returns value for given date from sorted lists of dates and values.
+    If there is no value for this date, returns the closest previous one,
+    or the closest next one if there are no previous values.
+
+    Parameters
+    ----------
+    dates: list
+        Sorted list of dates.
+    values: list
+        Values for each date in dates list.
+    step_date: datetime.date
+        The date to look up.
+
+    Returns
+    -------
+    Value for given date or None if lists are empty.
+    """
+    idx = bisect_right(dates, step_date) - 1
+    if idx >= 0:
+        return values[idx]
+
+    idx = bisect_left(dates, step_date)
+    if idx < len(dates):
+        return values[idx]
+    return None
+
+
+def get_seconds_till_tomorrow():
+    """
+    Returns number of seconds till the start of the next day.
+
+    Returns
+    -------
+    int
+    """
+    now = datetime.datetime.now()
+    tomorrow = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time.min)
+    return int((tomorrow - now).total_seconds()) + 1
+
+
+def get_calculate_cache_version():
+    """
+    Returns current version of cached calculations.
+
+    Returns
+    -------
+    int
+    """
+    return cache.get_or_set(CALCULATE_CACHE_VERSION_KEY, 1, None)
+
+
+def invalidate_calculate_cache():
+    """
+    Invalidates all cached calculations by bumping their version.
+
+    It's called by CSVFile.parse only, so data changed in other ways (admin edits,
+    edit-mode saves) stays cached until midnight. The version lives in the cache
+    backend, so other processes see it only with a shared backend (memcached, redis);
+    with per-process LocMemCache they keep serving old data until midnight.
+    """
+    cache.add(CALCULATE_CACHE_VERSION_KEY, 1, None)
+    cache.incr(CALCULATE_CACHE_VERSION_KEY)
+
+
+def get_change_percent(current, base):
+    """
+    Returns change of current value relative to base value in percents.
+
+    Parameters
+    ----------
+    current:
+        Current value.
+    base:
+        Value to compare with.
+
+    Returns
+    -------
+    Change in percents or None if base value is empty or zero.
+    """
+    if not base:
+        return None
+    return ((current - base)/base)*100
 
 
 class CSVFile(ModelWithTimestamp):
@@ -56,32 +169,31 @@ class CSVFile(ModelWithTimestamp):
     TYPE_EXCHANGE_RATES = 9
     TYPE_SHARE_SPECIFICATIONS = 10
 
-    FILE_TYPES = (
-        (TYPE_INDEX, 'Composite index'),
-        (TYPE_SHEET, 'Sheet g/p'),
-        (TYPE_BALKA, 'Beam'),
-        (TYPE_SCHVELLER, 'Channel'),
-        (TYPE_UGOLOK, 'Corner'),
-        (TYPE_PROFIL_TRUBA, 'Profile pipe'),
-        (TYPE_KRUGLAYA_TRUBA, 'Round tube'),
-        (TYPE_FINAL_METHOD, 'Indicator by final method'),
-        (TYPE_EXCHANGE_RATES, 'Exchange rates'),
-        (TYPE_SHARE_SPECIFICATIONS, 'Specification shares'),
-    )
-
-    TYPE_SIZES = {
-        TYPE_INDEX: '',
-        TYPE_SHEET: 'from 5 to 14 mm',
-        TYPE_BALKA: '№20',
-        TYPE_SCHVELLER: '№18',
-        TYPE_UGOLOK: '63х5',
-        TYPE_PROFIL_TRUBA: '100х4',
-        TYPE_KRUGLAYA_TRUBA: '114х4',
-        TYPE_FINAL_METHOD: '',
-        TYPE_EXCHANGE_RATES: '',
-        TYPE_SHARE_SPECIFICATIONS: ''
+    # Title and size for each type.
+    TYPE_META = {
+        TYPE_INDEX: ('Composite index', ''),
+        TYPE_SHEET: ('Sheet g/p', 'from 5 to 14 mm'),
+        TYPE_BALKA: ('Beam', '№20'),
+        TYPE_SCHVELLER: ('Channel', '№18'),
+        TYPE_UGOLOK: ('Corner', '63х5'),
+        TYPE_PROFIL_TRUBA: ('Profile pipe', '100х4'),
+        TYPE_KRUGLAYA_TRUBA: ('Round tube', '114х4'),
+        TYPE_FINAL_METHOD: ('Indicator by final method', ''),
+        TYPE_EXCHANGE_RATES: ('Exchange rates', ''),
+        TYPE_SHARE_SPECIFICATIONS: ('Specification shares', ''),
     }
 
+    FILE_TYPES = tuple((type_, meta[0]) for type_, meta in TYPE_META.items())
+
+    TYPE_SIZES = {type_: meta[1] for type_, meta in TYPE_META.items()}
+
+    # Types which have no graphs.
+    EXCLUDED_GRAPH_TYPES = frozenset({
+        TYPE_FINAL_METHOD,
+        TYPE_EXCHANGE_RATES,
+        TYPE_SHARE_SPECIFICATIONS,
+    })
+
     UAH = 1
     USD = 2
     EURO = 3
@@ -92,6 +204,8 @@ class CSVFile(ModelWithTimestamp):
         (EURO, 'Euro'),
     )
 
+    CURRENCIES_DATA = tuple({'code': code, 'title': title} for code, title in CURRENCY_LIST)
+
     CURRENCY_FIELDS = {
         UAH: 'avg_uah',
         USD: 'avg_usd',
@@ -111,13 +225,26 @@ class CSVFile(ModelWithTimestamp):
         super(CSVFile, self).save(*args, **kwargs)
 
         if not edit_mode:
-            from project.core.utils import parse_csv
-            parse_csv(self.id)
+            # Parse file only when it is stored, skip it if transaction rolls back.
+            transaction.on_commit(self.parse)
+
+    def parse(self):
+        """
+        Parses the file and drops cached calculations based on old data.
+        """
+        global _parse_csv
+        if _parse_csv is None:
+            # Imported here to avoid circular import.
+            from project.core.utils import parse_csv as _parse_csv
+        _parse_csv(self.id)
+        invalidate_calculate_cache()
 
     @classmethod
+    @functools.lru_cache(maxsize=None)
     def get_class_mapping(cls):
         """
         Returns mapping of graphs and model classes for them.
+        The result is cached, so it must not be modified.
 
         Returns
         -------
@@ -141,9 +268,9 @@ class CSVFile(ModelWithTimestamp):
 
         # Translate string format to the date object.
         if date_from and isinstance(date_from, str):
-            date_from = datetime.datetime.strptime(date_from, "%Y-%m-%d").date()
+            date_from = parse_date(date_from)
         if date_to and isinstance(date_to, str):
-            date_to = datetime.datetime.strptime(date_to, "%Y-%m-%d").date()
+            date_to = parse_date(date_to)
 
         if not date_to:
             date_to = datetime.date.today()
@@ -151,69 +278,60 @@ class CSVFile(ModelWithTimestamp):
         if not date_from:
             date_from = date_to - datetime.timedelta(days=cls.DEFAULT_DATE_DELTA_DAYS)
 
-        dates = []
-        while date_from <= date_to:
-            dates.append(date_from)
-            date_from += datetime.timedelta(days=1)
-
-        return dates
+        days_count = (date_to - date_from).days
+        return [date_from + datetime.timedelta(days=i) for i in range(days_count + 1)]
 
     @classmethod
     def get_currencies(cls):
         """
         Returns data of currencies.
+        The result is shared, so it must not be modified.
 
         Returns
         -------
-        list
+        tuple
         """
-        currencies = []
-        for currency in cls.CURRENCY_LIST:
-            currencies.append({
-                    'code': currency[0],
-                    'title': currency[1]
-                })
-        return currencies
+        return cls.CURRENCIES_DATA
 
     @classmethod
+    @functools.lru_cache(maxsize=None)
     def get_types_title_dict(cls):
         """
+        Returns mapping of types and their titles with sizes.
+        The result is cached, so it must not be modified.
+
         Returns
         -------
         dict
         """
-        types_dict = {}
-        for type_ in cls.FILE_TYPES:
-            types_dict[type_[0]] = '{} {}'.format(type_[1], cls.TYPE_SIZES[type_[0]])
-        return types_dict
+        return {
+            type_: f"{title} {size}" if size else title
+            for type_, (title, size) in cls.TYPE_META.items()
+        }
 
     @classmethod
+    @functools.lru_cache(maxsize=None)
     def get_graph_types(cls):
         """
         Returns data with grap types.
+        The result is cached, so it must not be modified.
 
         Returns
         -------
-        list
+        tuple
         """
-        types = []
-        exclude_types = (
-            cls.TYPE_FINAL_METHOD,
-            cls.TYPE_EXCHANGE_RATES,
-            cls.TYPE_SHARE_SPECIFICATIONS
+        return tuple(
+            {'code': type_, 'title': title}
+            for type_, title in cls.FILE_TYPES
+            if type_ not in cls.EXCLUDED_GRAPH_TYPES
         )
-        for t in cls.FILE_TYPES:
-            if not t[0] in exclude_types:
-                types.append({
-                        'code': t[0],
-                        'title': t[1]
-                    })
-        return types
 
     @classmethod
+    @functools.lru_cache(maxsize=None)
     def get_graph_names(cls):
         """
         Returns mapping of actual names for graph types.
+        The result is cached, so it must not be modified.
 
         Returns
         -------
@@ -225,9 +343,11 @@ class CSVFile(ModelWithTimestamp):
         return names
 
     @classmethod
+    @functools.lru_cache(maxsize=None)
     def get_fields_for_table(cls):
         """
         Returns mapping of fields for the table.
+        The result is cached, so it must not be modified.
 
         Returns
         -------
@@ -245,7 +365,8 @@ class CSVFile(ModelWithTimestamp):
     @classmethod
     def get_specification_percent(cls):
         """
-        Default values for specification.
+        Default values for specification, keyed by graph type.
+        New dict is built on each call, so callers may override the values.
 
         Returns
         -------
@@ -253,27 +374,27 @@ class CSVFile(ModelWithTimestamp):
         """
         names_dict = CSVFile.get_graph_names()
         return {
-            '{}'.format(cls.TYPE_SHEET): {
+            cls.TYPE_SHEET: {
                 'title': names_dict[cls.TYPE_SHEET],
                 'value': 60,
             },
-            '{}'.format(cls.TYPE_BALKA): {
+            cls.TYPE_BALKA: {
                 'title': names_dict[cls.TYPE_BALKA],
                 'value': 10
             },
-            '{}'.format(cls.TYPE_SCHVELLER): {
+            cls.TYPE_SCHVELLER: {
                 'title': names_dict[cls.TYPE_SCHVELLER],
                 'value': 10
             },
-            '{}'.format(cls.TYPE_UGOLOK): {
+            cls.TYPE_UGOLOK: {
                 'title': names_dict[cls.TYPE_UGOLOK],
                 'value': 10
             },
-            '{}'.format(cls.TYPE_PROFIL_TRUBA): {
+            cls.TYPE_PROFIL_TRUBA: {
                 'title': names_dict[cls.TYPE_PROFIL_TRUBA],
                 'value': 5
             },
-            '{}'.format(cls.TYPE_KRUGLAYA_TRUBA): {
+            cls.TYPE_KRUGLAYA_TRUBA: {
                 'title': names_dict[cls.TYPE_KRUGLAYA_TRUBA],
                 'value': 5
             }
@@ -290,6 +411,7 @@ class CalculateMixin:
     def get_data_charts(cls, dates, currency=None):
         """
         Returns prepared data for charts by given dates.
+        Result is cached till the end of the day, see invalidate_calculate_cache.
         """
 
         # Invalid period
@@ -305,34 +427,56 @@ class CalculateMixin:
         if cls.__name__ == 'CompositeIndex':
             calculating_field = calculating_field.replace('avg_', '')
 
-        calculated_data = []
+        cache_key = f"charts:{cls.__name__}:{calculating_field}:{dates[0]}:{dates[-1]}"
+        cache_version = get_calculate_cache_version()
+        calculated_data = cache.get(cache_key, version=cache_version)
+        if calculated_data is not None:
+            return calculated_data
 
         # Trying to find 'standard' value, which we want to use as the absolute value.
-        standart_value = cls.objects.filter(date__lte=dates[0]).last()
+        standart_value = cls.objects.filter(
+            date__lte=dates[0]
+        ).order_by('-date').values_list(calculating_field, flat=True).first()
 
         # TODO: Is this case possible?
-        if not standart_value:
+        if standart_value is None:
             return
 
-        standart_value = getattr(standart_value, calculating_field)
-        data_from_db = cls.objects.filter(date__gte=dates[0], date__lte=dates[-1])
+        # Fetch the whole period with a single query, indexed by date.
+        values_by_date = dict(
+            cls.objects.filter(
+                date__gte=dates[0], date__lte=dates[-1]
+            ).values_list('date', calculating_field)
+        )
 
         # Go across each date in dates list.
-        for step_date in dates:
-            step_value = data_from_db.filter(date=step_date).first()
-
-            step_value = getattr(step_value, calculating_field) if step_value else standart_value
-            if standart_value == 0:
-                calculated_data.append(step_value)
-            else:
-                calculated_data.append((step_value*100)/standart_value)
+        calculated_data = [values_by_date.get(step_date, standart_value) for step_date in dates]
+        if standart_value != 0:
+            calculated_data = [(step_value*100)/standart_value for step_value in calculated_data]
 
+        cache.set(cache_key, calculated_data, get_seconds_till_tomorrow(), version=cache_version)
         return calculated_data
 
     @classmethod
-    def grahp_specification_data(cls, dates, currency=None, **kwargs):
+    def grahp_specification_data(cls, dates, currency=None, specification=None, **kwargs):
         """
         Returns data for the graphic with the custom specification.
+
+        Parameters
+        ----------
+        dates: list
+            Dates of the period.
+        currency: int or str
+            Currency code, hryvna by default.
+        specification: dict
+            Mapping of graph types to dicts with percent 'value',
+            as returned by CSVFile.get_specification_percent (used by default).
+            Keys may be ints or their string form. Specification may also be
+            given as keyword arguments with string keys.
+
+        Returns
+        -------
+        list
         """
 
         # Invalid period
@@ -345,40 +489,42 @@ class CalculateMixin:
             calculating_field = 'avg_uah'
 
         data_classes = CSVFile.get_class_mapping()
+        specification = specification or kwargs or CSVFile.get_specification_percent()
+        weights = {int(graph_key): value['value'] for graph_key, value in specification.items()}
         calculated_data = []
-        cached_data = {}
+        cached_data = []
 
         standart_value = 0
 
-        # Cache filtered data.
-        for graph_key in kwargs.keys():
-            klass = data_classes.get(int(graph_key))
-            period_data = klass.objects.filter(date__gte=dates[0], date__lte=dates[-1])
-            if not period_data.exists():
-                period_data = klass.objects.filter(date__lte=dates[-1])
-            cached_data[graph_key] = period_data
+        # Cache data of each graph as sorted dates and values lists.
+        for graph_key, weight in weights.items():
+            klass = data_classes[graph_key]
+            data = klass.objects.values_list('date', calculating_field)
+
+            # Period data with the closest previous row, to fall back on it
+            # for dates without data.
+            before = data.filter(date__lt=dates[0]).order_by('-date')[:1]
+            period = data.filter(date__gte=dates[0], date__lte=dates[-1]).order_by('date')
+            period_data = list(before) + list(period)
 
             # Why no data?
             if not period_data:
                 continue
 
-            standard_value += getattr(period_data.first(), calculating_field)*kwargs[graph_key]['value']
+            dates_arr = [row[0] for row in period_data]
+            vals_arr = [row[1] for row in period_data]
+            cached_data.append((dates_arr, vals_arr, weight))
 
-        # Go across each date in dates list.
-        for step_date in dates:
-            # Summ of all graphics according specification percent.
-            summ = 0
-            for graph_key in cached_data:
-                data_step = cached_data[graph_key].filter(date=step_date).first()
-                if not data_step:
-                    data_step = cached_data[graph_key].filter(date__lte=step_date).last()
-                if not data_step:
-                    data_step = cached_data[graph_key].filter(date__gte=step_date).first()
-                # Why no data?
-                if not data_step:
-                    continue
-                summ += getattr(data_step, calculating_field)*kwargs[graph_key]['value']
+            standart_value += get_nearest_value(dates_arr, vals_arr, dates[0])*weight
+
+        # Values of each graph for all dates according specification percent.
+        weighted_data = [
+            [get_nearest_value(dates_arr, vals_arr, step_date)*weight for step_date in dates]
+            for dates_arr, vals_arr, weight in cached_data
+        ]
 
+        # Summ of all graphics for each date.
+        for summ in map(sum, zip(*weighted_data)):
             calculated_data.append((summ*100)/standart_value)
 
         return calculated_data
@@ -387,35 +533,66 @@ class CalculateMixin:
     def get_data_table(cls, price_field):
         """
         Returns data to show on the table.
+        Result is cached till the end of the day, see invalidate_calculate_cache.
         """
         today = datetime.date.today()
 
-        # Data for current data
-        today_data = cls.objects.filter(date__lte=today).last()
+        cache_key = f"table:{cls.__name__}:{price_field}:{today}"
+        cache_version = get_calculate_cache_version()
+        data = cache.get(cache_key, version=cache_version)
+        if data is not None:
+            return data
 
-        # Data for month ago
         month_ago = today - relativedelta(months=1)
-        month_ago_data = cls.objects.filter(date__lte=month_ago).last()
-
-        # Data for start of the year
-        start_year_data = cls.objects.filter(date__year__gte=today.year).first()
-        if not start_year_data:
-            start_year_data = cls.objects.filter(date__year__lte=today.year).last()
-
-        # Data for year ago
+        start_year = datetime.date(today.year, 1, 1)
         year_ago = today - relativedelta(years=1)
-        year_ago_data = cls.objects.filter(date__lte=year_ago).last()
 
-        # Convert common data to prices
-        today_data = getattr(today_data, price_field)
-        month_ago_data = getattr(month_ago_data, price_field)
-        start_year_data = getattr(start_year_data, price_field)
-        year_ago_data = getattr(year_ago_data, price_field)
+        today_data = None
+        month_ago_data = None
+        start_year_data = None
+        year_ago_data = None
+
+        # Go back from today till a week before year ago within one query,
+        # until data for year ago is found.
+        prices = cls.objects.order_by('-date').values_list('date', price_field)
+        rows = prices.filter(date__lte=today, date__gte=year_ago - relativedelta(weeks=1))
+        for row_date, value in rows:
+            # Data for current data
+            if today_data is None:
+                today_data = value
+
+            # Data for start of the year (the earliest one in this year)
+            if row_date >= start_year:
+                start_year_data = value
+
+            # Data for month ago
+            if month_ago_data is None and row_date <= month_ago:
+                month_ago_data = value
+
+            # Data for year ago
+            if row_date <= year_ago:
+                year_ago_data = value
+                break
+
+        # No data for year ago in the window, so take the closest previous one.
+        # It's also the closest one for other dates without data in the window.
+        if year_ago_data is None:
+            year_ago_data = prices.filter(date__lte=year_ago).values_list(price_field, flat=True).first()
+            if today_data is None:
+                today_data = year_ago_data
+            if month_ago_data is None:
+                month_ago_data = year_ago_data
+
+        # No data in this year, so use the latest one.
+        if start_year_data is None:
+            start_year_data = today_data
 
         data = {
             'current': today_data,
-            'month_ago': ((today_data-month_ago_data)/month_ago_data)*100,
-            'start_year': ((today_data-start_year_data)/start_year_data)*100,
-            'year_ago': ((today_data-year_ago_data)/year_ago_data)*100,
+            'month_ago': get_change_percent(today_data, month_ago_data),
+            'start_year': get_change_percent(today_data, start_year_data),
+            'year_ago': get_change_percent(today_data, year_ago_data),
         }
+
+        cache.set(cache_key, data, get_seconds_till_tomorrow(), version=cache_version)
         return data